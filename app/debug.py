@@ -8,9 +8,12 @@ import math
 import random
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from functools import wraps
-from timeit import default_timer as timer
+
+from peewee import chunked
 
 from proxytools.app import App
 from proxytools.config import Config
@@ -20,136 +23,211 @@ from proxytools.models import Proxy, ProxyTest, ProxyProtocol, ProxyStatus, DBCo
 
 log = logging.getLogger()
 
+PROTOCOLS = tuple(map(int, ProxyProtocol))
+STATUSES = tuple(map(int, ProxyStatus))
+STATUSES_OK = (int(ProxyStatus.OK),)
+
+# Column order of the tuple rows generated for ProxyTest.insert_many()/bulk_load()
+PROXYTEST_FIELDS = [ProxyTest.proxy, ProxyTest.latency, ProxyTest.status]
+
+# Rows per INSERT statement, keeps statements below max_allowed_packet
+INSERT_BATCH_SIZE = 1000
+
+# Upper bound of parallel inserters, each holds a connection from the database pool
+MAX_POPULATE_WORKERS = 8
+
+
+@contextmanager
+def timed(msg, *args):
+    """ Log the time spent in the block, message is formatted lazily """
+    start_time = time.perf_counter()
+    yield
+    log.info(msg + ' took: %.3fs', *args, time.perf_counter() - start_time)
+
 
 def timeit(func):
     @wraps(func)
     def timeit_wrapper(*args, **kwargs):
-        start_time = time.perf_counter()
-        result = func(*args, **kwargs)
-        end_time = time.perf_counter()
-        total_time = end_time - start_time
-        log.info(f'Function {func.__name__}{args} {kwargs} Took {total_time:.3f} seconds')
-        return result
+        with timed('Function %s%s %s', func.__name__, args, kwargs):
+            return func(*args, **kwargs)
     return timeit_wrapper
 
 
+@contextmanager
+def unchecked_transaction(database):
+    """ Run bulk inserts in a single transaction without key checks """
+    database.execute_sql('SET UNIQUE_CHECKS=0;')
+    database.execute_sql('SET FOREIGN_KEY_CHECKS=0;')
+    try:
+        with database.atomic():
+            yield
+    finally:
+        database.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
+        database.execute_sql('SET UNIQUE_CHECKS=1;')
+
+
 @timeit
 def add_proxies(amount=1):
-    data = []
-    protocols = list(map(int, ProxyProtocol))
-    for i in range(amount):
-        port = random.randint(80, 9000)
-        data.append({
-            'ip': random_ip(),
-            'port': port,
-            'protocol': random.choices(protocols)[0]
-        })
+    # Generate whole columns at once instead of per-row random calls
+    ips = [random_ip() for i in range(amount)]
+    ports = random.choices(range(80, 9001), k=amount)
+    data = [
+        {'ip': ip, 'port': port, 'protocol': protocol}
+        for ip, port, protocol in zip(
+            ips, ports, random.choices(PROTOCOLS, k=amount))
+    ]
 
-    q = Proxy.bulk_insert(data)
-    return q
+    return insert_proxies(data)
 
 
 @timeit
-def add_proxytests(proxy_id, amount=3, only_valid=False):
-    data = []
+def insert_proxies(proxylist):
+    """
+    Insert proxies in chunks within one transaction, skipping duplicates.
 
+    Returns:
+        int count: inserted proxy count
+    """
+    row_count = 0
+    with Proxy.database().atomic():
+        for batch in chunked(proxylist, INSERT_BATCH_SIZE):
+            row_count += Proxy.insert_many(batch).on_conflict_ignore().as_rowcount().execute()
+    return row_count
+
+
+@timeit
+def add_proxytests(proxy_id, amount=3, only_valid=False):
     if only_valid:
-        statuses = [ProxyStatus.OK]
+        statuses = STATUSES_OK
     else:
-        statuses = list(map(int, ProxyStatus))
+        statuses = STATUSES
 
-    for i in range(amount):
-        data.append({
-            'proxy_id': proxy_id,
-            'latency': random.randint(50, 5000),
-            'status': random.choices(statuses)[0]
-        })
+    latencies = random.choices(range(50, 5001), k=amount)
+    data = [
+        (proxy_id, latency, status)
+        for latency, status in zip(
+            latencies, random.choices(statuses, k=amount))
+    ]
 
-    q = ProxyTest.insert_many(data)
+    q = ProxyTest.insert_many(data, fields=PROXYTEST_FIELDS)
     return q.execute()
 
 
 def populate_proxies(proxy_count=1000):
-    start_time = timer()
-    db_proxy_count = Proxy.select().count()
-    elapsed_time = timer() - start_time
-    log.info(f'{db_proxy_count} proxies in the database. Query took: {elapsed_time:.3f}s')
+    with timed('Counting proxies'):
+        db_proxy_count = Proxy.row_count()
+    log.info('%d proxies in the database.', db_proxy_count)
 
     proxy_count -= db_proxy_count
 
     if proxy_count > 0:
-        log.info(f'Inserting {proxy_count} proxies...')
-        start_time = timer()
-        add_proxies(proxy_count)
-        elapsed_time = timer() - start_time
-        log.info(f"Inserting {proxy_count} proxies took: {elapsed_time:.3f}s")
+        with timed('Inserting %d proxies', proxy_count):
+            add_proxies(proxy_count)
 
 
 def populate_proxytests(testspp=5, only_valid=False):
-    data = []
-
     if only_valid:
-        statuses = [ProxyStatus.OK]
+        statuses = STATUSES_OK
     else:
-        statuses = list(map(int, ProxyStatus))
-
-    db_proxy_count = Proxy.select().count()
-    test_count = db_proxy_count/testspp
-    q = Proxy.select(Proxy.id).dicts()
-
-    for proxy_id in q:
-        for i in range(test_count):
-            data.append({
-                'proxy_id': proxy_id,
-                'latency': random.randint(50, 5000),
-                'status': random.choices(statuses)[0]
-            })
-
-    q = ProxyTest.insert_many(data)
-    return q.execute()
+        statuses = STATUSES
+
+    q = Proxy.select(Proxy.id).tuples().iterator()
+    data = generate_proxytests((proxy_id for (proxy_id,) in q), testspp, statuses)
+
+    with unchecked_transaction(ProxyTest.database()):
+        for batch in chunked(data, INSERT_BATCH_SIZE):
+            ProxyTest.insert_many(batch, fields=PROXYTEST_FIELDS).execute()
+
+
+def generate_proxytests(proxy_ids, testspp, statuses=STATUSES):
+    """ Yield `testspp` random test rows for each proxy """
+    # Local aliases skip the module attribute lookups on every row
+    randint = random.randint
+    choice = random.choice
+    for proxy_id in proxy_ids:
+        for i in range(testspp):
+            yield (proxy_id, randint(50, 5000), choice(statuses))
+
+
+def insert_proxytests(proxy_ids, testspp):
+    """ Insert `testspp` random tests for each proxy using a pooled connection """
+    database = ProxyTest.database()
+    database.connect(reuse_if_open=True)
+    try:
+        with unchecked_transaction(database):
+            rows = generate_proxytests(proxy_ids, testspp)
+            for batch in chunked(rows, INSERT_BATCH_SIZE):
+                ProxyTest.insert_many(batch, fields=PROXYTEST_FIELDS).execute()
+    finally:
+        database.close()
+
+
+def parallel_insert_proxytests(proxy_ids, testspp, workers):
+    """ Split proxies across `workers` and insert their tests concurrently """
+    if not proxy_ids:
+        return
+
+    size = math.ceil(len(proxy_ids) / workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(insert_proxytests, proxy_ids[idx:idx + size], testspp)
+            for idx in range(0, len(proxy_ids), size)
+        ]
+        for future in futures:
+            future.result()
+
+
+def load_proxytests(rows):
+    """
+    Bulk load proxy test rows with `ProxyTest.bulk_load` (LOAD DATA LOCAL INFILE).
+    Requires `--db-load-data` and `local_infile` enabled on the MySQL server.
+    """
+    return ProxyTest.bulk_load(rows, PROXYTEST_FIELDS)
 
 
-def populate_data(proxy_count=1000, test_count=250000):
-    start_time = timer()
-    db_proxy_count = Proxy.select().count()
-    elapsed_time = timer() - start_time
-    log.info(f'{db_proxy_count} proxies in the database. Query took: {elapsed_time:.3f}s')
+def populate_data(proxy_count=1000, test_count=250000, load_infile=False):
+    with timed('Counting proxies'):
+        db_proxy_count = Proxy.row_count()
+    log.info('%d proxies in the database.', db_proxy_count)
 
     proxy_count -= db_proxy_count
 
     if proxy_count > 0:
-        log.info(f'Inserting {proxy_count} proxies...')
-        start_time = timer()
-        add_proxies(proxy_count)
-        elapsed_time = timer() - start_time
-        log.info(f"Inserting {proxy_count} proxies took: {elapsed_time:.3f}s")
-
-    start_time = timer()
-    db_test_count = ProxyTest.select().count()
-    elapsed_time = timer() - start_time
-    log.info(f'{db_test_count} proxy tests in the database. Query took: {elapsed_time:.3f}s')
+        with timed('Inserting %d proxies', proxy_count):
+            db_proxy_count += add_proxies(proxy_count)
+
+    with timed('Counting proxy tests'):
+        db_test_count = ProxyTest.row_count()
+    log.info('%d proxy tests in the database.', db_test_count)
+
     test_count -= db_test_count
 
     if test_count > 0:
-        # refresh number of existing proxies
-        db_proxy_count = Proxy.select().count()
         testspp = math.ceil(test_count / db_proxy_count)
+        query = Proxy.get_random(db_proxy_count).select(Proxy.id).tuples()
+        proxy_ids = [proxy_id for (proxy_id,) in query.iterator()]
 
-        log.info(f'Inserting {test_count} tests, {testspp} on each proxy...')
-        start_time = timer()
-        for proxy in Proxy.get_random(db_proxy_count).dicts():
-            add_proxytests(proxy['id'], testspp, False)
-        elapsed_time = timer() - start_time
-        log.info(f'Inserting {test_count} tests took: {elapsed_time:.3f}s')
+        log.info('Inserting %d tests, %d on each proxy...', test_count, testspp)
+        with timed('Inserting %d tests', test_count):
+            if load_infile:
+                load_proxytests(generate_proxytests(proxy_ids, testspp))
+            else:
+                # Leave a pooled connection free for the main thread
+                db_max_conn = Config.get_args().db_max_conn
+                workers = max(1, min(MAX_POPULATE_WORKERS, db_max_conn - 1))
+                parallel_insert_proxytests(proxy_ids, testspp, workers)
 
 
 @timeit
 def query_valid(limit=1000, output=False):
-    q = Proxy.get_valid(limit)
-    log.debug(q.sql())
-    l = [m for m in q.dicts()]
+    q = Proxy.get_valid(limit).select(
+        Proxy.id, Proxy.ip, Proxy.port, Proxy.protocol,
+        Proxy.username, Proxy.password)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(q.sql())
+    rows = list(q.dicts())
     if output:
-        pprint(l)
+        pprint(rows)
 
 
 @timeit
@@ -164,6 +242,12 @@ def query_oldest_test(proxy: Proxy):
     pprint(q)
 
 
+@timeit
+def query_test_bounds(proxy: Proxy):
+    q = proxy.test_id_bounds()
+    pprint(q)
+
+
 @timeit
 def query_delete_failed():
     q = Proxy.delete_failed()
@@ -204,6 +288,6 @@ if __name__ == '__main__':
         },
     ]
 
-    Proxy.bulk_insert(proxies)
+    insert_proxies(proxies)
     """
 
@@ -0,0 +1,8 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from proxytools.cli import main
+
+
+if __name__ == '__main__':
+    main()
@@ -6,15 +6,20 @@ import signal
 import sys
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import starmap
 from timeit import default_timer
 
 from proxytools import utils
 from proxytools.config import Config
 from proxytools.test_manager import TestManager
 from proxytools.proxy_parser import ProxyParser
-from proxytools.models import ProxyProtocol, Proxy
+from proxytools.models import PROTOCOL_SCHEMES, ProxyProtocol, Proxy
 from proxytools.db import Database, DatabaseQueue
 
+__all__ = ['App']
+
 log = logging.getLogger(__name__)
 
 
@@ -22,17 +27,34 @@ class App:
 
     def __init__(self):
         self.args = Config.get_args()
-        log.info(f'Found local IP: {self.args.local_ip}')
+        log.info('Found local IP: %s', self.args.local_ip)
         self.db = Database()
         self.db_queue = DatabaseQueue.get_db_queue()
         self.manager = TestManager()
         self.parser = ProxyParser()
+        self.outputs = self.__enabled_outputs()
+        # Distinct protocols required by enabled outputs
+        self.output_protocols = set(protocol for _, protocol, _, _ in self.outputs)
+
+    def __enabled_outputs(self):
+        """ Enabled outputs as: (filename, protocol, export function, options) """
+        args = self.args
+        outputs = [
+            (args.output_kinancity, ProxyProtocol.HTTP, App.export_kinancity, {}),
+            (args.output_proxychains, args.proxy_protocol, App.export_proxychains, {}),
+            (args.output_rocketmap, ProxyProtocol.SOCKS5, App.export, {}),
+            (args.output_http, ProxyProtocol.HTTP, App.export,
+             {'no_protocol': args.output_no_protocol}),
+            (args.output_socks, ProxyProtocol.SOCKS5, App.export,
+             {'no_protocol': args.output_no_protocol}),
+        ]
+        return [output for output in outputs if output[0]]
 
     def start(self):
         try:
             self.__launch()
             self.__work()
-        except (KeyboardInterrupt, SystemExit):
+        except SystemExit:
             pass
         except Exception as e:
             log.exception(e)
@@ -44,6 +66,10 @@ class App:
         sys.exit(0)
 
     def __launch(self):
+        # Handle SIGINT/SIGTERM gracefully by interrupting the work loop
+        signal.signal(signal.SIGINT, self.__signal_handler)
+        signal.signal(signal.SIGTERM, self.__signal_handler)
+
         # Validate proxy tester benchmark responses
         if self.manager.validate_responses():
             log.info('Test manager response validation was successful.')
@@ -59,8 +85,9 @@ class App:
         # Fetch and insert new proxies from configured sources
         self.parser.load_proxylist()
 
-        # Handle SIGTERM gracefully
-        signal.signal(signal.SIGTERM, utils.sigterm_handler)
+    def __signal_handler(self, signum, frame):
+        log.info('Received signal %d, stopping work.', signum)
+        self.manager.interrupt.set()
 
     def __stop(self):
         log.info('Shutting down...')
@@ -70,99 +97,98 @@ class App:
         self.db_queue.stop()
 
     def __work(self):
-        refresh_timer = default_timer()
-        output_timer = default_timer()
+        args = self.args
+        interrupt = self.manager.interrupt
+        interrupt_is_set = interrupt.is_set
+        queue_interrupt_is_set = self.db_queue.interrupt.is_set
+        load = self.parser.load_proxylist
+        output = self.__output
+        timer = default_timer
+        now = timer()
+        notice_timer = now
+        refresh_timer = now + args.proxy_refresh_interval
+        # Retry of a failed response validation, only scheduled after failures
+        validate_timer = float('inf')
+        output_timer = now + args.output_interval
+        force_output_timer = now + args.output_force_interval
+        dirty = self.manager.dirty
         errors = 0
 
         while True:
-            self.db.print_stats()
-            self.db_queue.print_stats()
-            if self.manager.interrupt.is_set() | self.db_queue.interrupt.is_set():
+            now = timer()
+            if now >= notice_timer:
+                notice_timer = now + args.manager_notice_interval
+                self.db.print_stats()
+                self.db_queue.print_stats()
+
+            if interrupt_is_set() | queue_interrupt_is_set():
                 break
 
-            now = default_timer()
-            if now > refresh_timer + self.args.proxy_refresh_interval:
-                refresh_timer = now
+            if now >= refresh_timer:
+                refresh_timer = now + args.proxy_refresh_interval
                 log.info('Refreshing proxylists from configured sources.')
-                self.parser.load_proxylist()
+                load()
+                # Validate along with the refresh
+                validate_timer = now
 
-                # Validate proxy tester benchmark responses
+            # Validate proxy tester benchmark responses
+            if now >= validate_timer:
+                validate_timer = float('inf')
                 if not self.manager.validate_responses():
                     log.error('Proxy tester response validation failed.')
                     errors += 1
                     if errors > 2:
                         break
+                    # Retry validation sooner with exponential backoff
+                    validate_timer = now + min(args.proxy_refresh_interval, 5 * (1 << errors))
                 else:
                     errors = 0
 
-            # Regular proxylist output
-            if now > output_timer + self.args.output_interval:
-                output_timer = now
-                self.__output()
-
-            time.sleep(60)
+            # Regular proxylist output, skipped if no new working proxies
+            if now >= output_timer:
+                output_timer = now + args.output_interval
+                if dirty.is_set() or now >= force_output_timer:
+                    force_output_timer = now + args.output_force_interval
+                    dirty.clear()
+                    output()
+
+            # Wait until the next scheduled task is due or work is interrupted
+            next_timer = min(notice_timer, refresh_timer, validate_timer, output_timer)
+            if interrupt.wait(max(0.0, next_timer - timer())):
+                break
 
     def __output(self):
-        args = self.args
+        outputs = self.outputs
+        if not outputs:
+            return
+
         log.info('Outputting working proxylist.')
-        Proxy.database().connect()
-        working_http = []
-        working_socks = []
-
-        if args.output_kinancity:
-            query = Proxy.get_valid(
-                args.output_limit,
-                args.proxy_scan_interval,
-                ProxyProtocol.HTTP)
-            working_http = query.execute()
-
-            App.export_kinancity(args.output_kinancity, working_http)
-
-        if args.output_proxychains:
-            query = Proxy.get_valid(
-                args.output_limit,
-                args.proxy_scan_interval,
-                args.proxy_protocol)
-            proxylist = query.execute()
-
-            App.export_proxychains(args.output_proxychains, proxylist)
-
-        if args.output_rocketmap:
-            query = Proxy.get_valid(
-                args.output_limit,
-                args.proxy_scan_interval,
-                ProxyProtocol.SOCKS5)
-            working_socks = query.execute()
-
-            App.export(args.output_rocketmap, working_socks)
-
-        if args.output_http:
-            if not working_http:
-                query = Proxy.get_valid(
-                    args.output_limit,
-                    args.proxy_scan_interval,
-                    ProxyProtocol.HTTP)
-                working_http = query.execute()
-
-            App.export(args.output_http, working_http, args.output_no_protocol)
-
-        if args.output_socks:
-            if not working_socks:
-                query = Proxy.get_valid(
-                    args.output_limit,
-                    args.proxy_scan_interval,
-                    ProxyProtocol.SOCKS5)
-                working_socks = query.execute()
-
-            App.export(args.output_socks, working_socks, args.output_no_protocol)
-
-        Proxy.database().close()
+
+        # Query each distinct protocol required by the enabled outputs once
+        proxylists = {}
+        # Connection is returned to the pool before writing files, even on errors
+        with Proxy.database().connection_context():
+            for protocol in self.output_protocols:
+                query = Proxy.get_valid_url_parts(
+                    self.args.output_limit,
+                    self.args.proxy_scan_interval,
+                    protocol)
+                proxylists[protocol] = list(query)
+
+        # Write output files concurrently, they share no state
+        with ThreadPoolExecutor(max_workers=min(4, len(outputs))) as executor:
+            futures = [
+                executor.submit(export, filename, proxylists[protocol], **options)
+                for filename, protocol, export, options in outputs
+            ]
+            for future in futures:
+                future.result()
 
     def __cleanup(self):
         """ Handle shutdown tasks """
-        Proxy.database().close()
         log.info('Shutdown complete.')
 
+    @staticmethod
     def export(filename, proxylist, no_protocol=False):
         if not proxylist:
             log.warning('Found no valid proxies in database.')
@@ -170,10 +196,11 @@ class App:
 
         log.info('Writing %d working proxies to: %s', len(proxylist), filename)
 
-        proxylist = [proxy.url(no_protocol) for proxy in proxylist]
+        proxylist = starmap(partial(Proxy.url_format, no_protocol=no_protocol), proxylist)
 
         utils.export_file(filename, proxylist)
 
+    @staticmethod
     def export_kinancity(filename, proxylist):
         if not proxylist:
             log.warning('Found no valid proxies in database.')
@@ -182,12 +209,11 @@ class App:
         log.info('Writing %d working proxies to: %s',
                  len(proxylist), filename)
 
-        proxylist = [proxy.url() for proxy in proxylist]
-
-        proxylist = '[' + ','.join(proxylist) + ']'
+        content = ','.join(starmap(Proxy.url_format, proxylist))
 
-        utils.export_file(filename, proxylist)
+        utils.export_file(filename, f'[{content}]')
 
+    @staticmethod
     def export_proxychains(filename, proxylist):
         if not proxylist:
             log.warning('Found no valid proxies in database.')
@@ -196,6 +222,11 @@ class App:
         log.info('Writing %d working proxies to: %s',
                  len(proxylist), filename)
 
-        proxylist = [proxy.url_proxychains() for proxy in proxylist]
+        # Inline `Proxy.url_proxychains_format` to avoid a call per proxy
+        schemes = PROTOCOL_SCHEMES
+        proxylist = (
+            f'{schemes[protocol]} {ip} {port} {username} {password}'
+            if username and password else f'{schemes[protocol]} {ip} {port}'
+            for ip, port, protocol, username, password in proxylist)
 
         utils.export_file(filename, proxylist)
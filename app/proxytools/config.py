@@ -1,130 +1,99 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from hashlib import blake2b
-from typing import Any
+from itertools import cycle
+from threading import Lock
+import io
 import os
 import sys
 
 import configargparse
-import pycountry
-
-from .models import ProxyProtocol
-from .utils import find_local_ip
 
 CWD = os.path.dirname(os.path.realpath(__file__))
 APP_PATH = os.path.realpath(os.path.join(CWD, '..'))
+DISABLE_VALUES = frozenset(('', 'none', 'false'))
+# Lazily built by `iso3166_1_index`
+ISO3166_1_INDEX = {}
+
+
+# Parsed and validated arguments, set once by `Config`
+ARGS = None
 
 
 class Config:
     """ Singleton class that parses and holds all the configuration arguments """
-    __args = None
-    __counter = 0
+    # Bound `__next__` of a cycle over the immutable proxy judge tuple
+    __next_proxy_judge = None
+    __proxy_judges_lock = Lock()
+    __init_lock = Lock()
 
     @staticmethod
     def get_args():
         """ Static access method """
-        if Config.__args is None:
-            Config()
-        return Config.__args
+        if ARGS is None:
+            # Lock only until the first parse, concurrent callers wait for it
+            with Config.__init_lock:
+                if ARGS is None:
+                    Config()
+        return ARGS
 
     @staticmethod
     def get_proxyjudge():
         """ Get and cycle proxy judges """
-        if Config.__args is None:
+        next_proxy_judge = Config.__next_proxy_judge
+        if next_proxy_judge is None:
             raise Exception('Must call Config.get_args() first!')
 
-        total = len(Config.__args.proxy_judge)
-        index = Config.__counter % total
-        proxyjudge = Config.__args.proxy_judge[index]
-        Config.__counter = (Config.__counter + 1) % total
-        return proxyjudge
+        with Config.__proxy_judges_lock:
+            return next_proxy_judge()
 
     def __init__(self):
         """ Parse config/CLI arguments and setup workspace """
-        if Config.__args is not None:
+        global ARGS
+        if ARGS is not None:
             raise Exception('This class is a singleton!')
 
-        Config.__args = get_args()
+        self.__args = get_args()
         self.__check_config()
+        Config.__next_proxy_judge = cycle(tuple(self.__args.proxy_judge)).__next__
+        ARGS = self.__args
 
     def __check_config(self):
         """ Validate configuration values """
+        # Deferred import, pulls in requests
+        from .utils import find_local_ip
+
         # if not self.__args.proxy_file and not self.__args.proxy_scrap:
         #     raise RuntimeError('You must supply a proxylist file or enable scrapping!')
 
         if not self.__args.proxy_judge:
             raise RuntimeError('You must specify a URL for an AZenv proxy judge.')
 
-        if self.__args.db_max_conn <= 5:
-            raise RuntimeError('Database max connections must be greater than 5.')
-
-        if self.__args.db_batch_size < 50:
-            raise RuntimeError('Database batch size must be greater than 50.')
+        # Validate proxy judges, querying them concurrently
+        proxy_judges = self.__args.proxy_judge
+        with ThreadPoolExecutor(max_workers=len(proxy_judges)) as executor:
+            local_ips = list(executor.map(find_local_ip, proxy_judges))
 
-        if self.__args.manager_testers <= 0:
-            raise RuntimeError('Proxy tester threads must be greater than 0.')
-
-        # Validate proxy judges
-        prev_ip = None
-        for pj in self.__args.proxy_judge:
-            local_ip = find_local_ip(pj)
-            if not prev_ip:
-                prev_ip = local_ip
-            elif local_ip != prev_ip:
-                RuntimeError(f'Proxy judge {pj}: {local_ip} '
-                             f'(before: {prev_ip})')
+        local_ip = local_ips[0]
+        for pj, pj_ip in zip(proxy_judges, local_ips):
+            if pj_ip != local_ip:
+                raise RuntimeError(f'Proxy judge {pj}: {pj_ip} '
+                                   f'(expected: {local_ip})')
 
         setattr(self.__args, 'local_ip', local_ip)
 
+        # Plain integer protocol value for comparisons on hot paths
+        protocol = self.__args.proxy_protocol
+        setattr(self.__args, 'proxy_protocol_value',
+                None if protocol is None else protocol.value)
+
         hash = blake2b(local_ip.encode(), digest_size=10).hexdigest()
         setattr(self.__args, 'hash', hash)
 
 
-###############################################################################
-# ArgParse helper class to deal with Enums.
-# https://stackoverflow.com/questions/43968006/support-for-enum-arguments-in-argparse
-###############################################################################
-
-class EnumAction(configargparse.Action):
-    """
-    ArgParse Action for handling Enum types
-    """
-    def __init__(self, **kwargs):
-        # Pop off the type value
-        enum_type = kwargs.pop('type', None)
-
-        # Ensure an Enum subclass is provided
-        if enum_type is None:
-            raise ValueError('type must be assigned an Enum when using EnumAction')
-        if not issubclass(enum_type, Enum):
-            raise TypeError('type must be an Enum when using EnumAction')
-
-        # Generate choices from the Enum
-        kwargs.setdefault('choices', tuple(e.name for e in enum_type))
-
-        super(EnumAction, self).__init__(**kwargs)
-
-        self._enum = enum_type
-
-    def __call__(self,
-                 parser: configargparse.ArgumentParser,
-                 namespace: configargparse.Namespace,
-                 value: Any,
-                 option_string: str = None):
-        # Convert value back into an Enum
-        if isinstance(value, str):
-            value = self._enum[value]
-            setattr(namespace, self.dest, value)
-        elif value is None:
-            msg = f'You need to pass a value after {option_string}!'
-            raise configargparse.ArgumentTypeError(msg)
-        else:
-            # A pretty invalid choice message will be generated by argparse
-            raise configargparse.ArgumentTypeError()
-
-
 ###############################################################################
 # ConfigArgParse definitions for current application.
 # The following code should have minimal dependencies.
@@ -133,7 +102,21 @@ class EnumAction(configargparse.Action):
 # the type converter is only applied if the default is a string.
 ###############################################################################
 
-def get_args():
+def open_config_file(filename, mode='r'):
+    """ Read config files with a single buffered read into memory """
+    if 'r' not in mode:
+        return open(filename, mode)
+
+    with open(filename, 'rb', buffering=1 << 16) as file:
+        return io.StringIO(file.read().decode('utf-8'))
+
+
+@lru_cache(maxsize=1)
+def build_parser():
+    """ Build the argument parser once, it is reused by later `get_args` calls """
+    # Deferred import, pulls in peewee
+    from .models import PROTOCOL_NAMES
+
     default_config = []
 
     config_file = os.path.normpath(
@@ -141,7 +124,8 @@ def get_args():
 
     if '-cf' not in sys.argv and '--config' not in sys.argv:
         default_config = [config_file]
-    parser = configargparse.ArgParser(default_config_files=default_config)
+    parser = configargparse.ArgParser(default_config_files=default_config,
+                                      config_file_open_func=open_config_file)
 
     parser.add_argument('-cf', '--config',
                         is_config_file=True, help='Set configuration file.')
@@ -190,11 +174,17 @@ def get_args():
     group.add_argument('--db-max-conn',
                        env_var='MYSQL_MAX_CONN',
                        help='Maximum number of connections to the database.',
-                       type=int, default=20)
+                       type=min_int(6), default=20)
     group.add_argument('--db-batch-size',
                        env_var='MYSQL_BATCH_SIZE',
                        help='Maximum number of rows to update per batch.',
-                       type=int, default=250)
+                       type=min_int(50), default=250)
+    group.add_argument('--db-load-data',
+                       env_var='MYSQL_LOAD_DATA',
+                       help=('Insert large proxy test batches with '
+                             'LOAD DATA LOCAL INFILE. '
+                             'Requires local_infile enabled on the server.'),
+                       action='store_true')
 
     group = parser.add_argument_group('Cleanup')
     group.add_argument('-Ca', '--cleanup-age',
@@ -222,8 +212,8 @@ def get_args():
                        action='store_true')
     group.add_argument('-Pp', '--proxy-protocol',
                        help='Specify proxy protocol we are testing.',
-                       action=EnumAction,
-                       type=ProxyProtocol)
+                       metavar='{%s}' % ','.join(PROTOCOL_NAMES),
+                       type=str_proxy_protocol)
     group.add_argument('-Pri', '--proxy-refresh-interval',
                        help=('Refresh proxylist from configured sources '
                              'every X minutes. Default: 180.'),
@@ -247,6 +237,12 @@ def get_args():
                              'Default: 60.'),
                        default=60,
                        type=int_minutes)
+    group.add_argument('-Ofi', '--output-force-interval',
+                       help=('Output working proxylist every X minutes even '
+                             'if no new working proxies were found. '
+                             'Default: 180.'),
+                       default=180,
+                       type=int_minutes)
     group.add_argument('-Ol', '--output-limit',
                        help=('Maximum number of proxies to output. '
                              'Default: 100.'),
@@ -291,7 +287,7 @@ def get_args():
                        help=('Maximum concurrent proxy testing threads. '
                              'Default: 100.'),
                        default=100,
-                       type=int)
+                       type=min_int(1))
     group.add_argument('-Ta', '--test-anonymity',
                        help='Test if proxy preserves anonymity.',
                        action='store_true')
@@ -338,9 +334,16 @@ def get_args():
                              'Format: <proto>://[<user>:<pass>@]<ip>:<port> '
                              'Default: None.'),
                        default=None)
+
+    return parser
+
+
+def get_args():
+    parser = build_parser()
     args = parser.parse_args()
 
-    if args.verbose:
+    # Print parsed configuration values only on debug verbosity (-vv)
+    if args.verbose >= 2:
         parser.print_values()
 
     # Helper attributes
@@ -349,40 +352,39 @@ def get_args():
     return args
 
 
-def int_minutes(arg: int):
-    interval = int(arg)
-
-    if interval <= 0:
-        raise ValueError('Negative time interval specified!')
-
-    return interval * 60
-
+def positive_interval(cast, scale=1):
+    """ Build a type converter for positive time intervals, scaled to seconds """
+    def converter(arg):
+        interval = cast(arg)
 
-def float_minutes(arg: float):
-    interval = float(arg)
+        if interval <= 0:
+            raise configargparse.ArgumentTypeError('Negative time interval specified!')
 
-    if interval <= 0:
-        raise ValueError('Negative time interval specified!')
+        return interval * scale
 
-    return interval * 60
+    # Shown by argparse on conversion errors, e.g. "invalid int value"
+    converter.__name__ = cast.__name__
+    return converter
 
 
-def int_seconds(arg: int):
-    interval = int(arg)
+int_minutes = positive_interval(int, 60)
+float_minutes = positive_interval(float, 60)
+int_seconds = positive_interval(int)
+float_seconds = positive_interval(float)
 
-    if interval <= 0:
-        raise ValueError('Negative time interval specified!')
 
-    return interval
+def min_int(minimum):
+    """ Build a type converter for integers with a lower bound """
+    def converter(arg):
+        value = int(arg)
 
+        if value < minimum:
+            raise configargparse.ArgumentTypeError(f'Minimum value is {minimum}!')
 
-def float_seconds(arg: float):
-    interval = float(arg)
+        return value
 
-    if interval <= 0:
-        raise ValueError('Negative time interval specified!')
-
-    return interval
+    converter.__name__ = 'int'
+    return converter
 
 
 def float_ratio(arg: float):
@@ -401,39 +403,55 @@ def str_path(arg: str):
     if arg is None:
         raise ValueError('Empty path specified!')
 
-    if os.path.isabs(arg):
-        path = arg
-    else:
-        path = os.path.abspath(f'{APP_PATH}/{arg}')
+    path = arg
+    if not os.path.isabs(path):
+        path = os.path.abspath(os.path.join(APP_PATH, path))
 
     # Create directory if path not found
-    if not os.path.exists(path):
-        os.mkdir(path)
+    os.makedirs(path, exist_ok=True)
     return path
 
 
 def str_disable(arg: str):
-    if arg is None or arg.lower() in ['none', 'false']:
+    if arg is None or arg.lower() in DISABLE_VALUES:
         return None
 
     return arg
 
 
+def str_proxy_protocol(arg: str):
+    from .models import PROTOCOL_NAMES, ProxyProtocol
+
+    try:
+        return ProxyProtocol[arg.upper()]
+    except KeyError:
+        choices = ', '.join(PROTOCOL_NAMES)
+        msg = f'invalid choice: "{arg}" (choose from {choices})'
+        raise configargparse.ArgumentTypeError(msg)
+
+
+def iso3166_1_index():
+    """ Map uppercase alpha-2, alpha-3 and numeric codes to alpha-2 codes """
+    if not ISO3166_1_INDEX:
+        # Deferred import, pycountry loads its database on first use
+        import pycountry
+
+        for country in pycountry.countries:
+            ISO3166_1_INDEX[country.alpha_2] = country.alpha_2
+            ISO3166_1_INDEX[country.alpha_3] = country.alpha_2
+            ISO3166_1_INDEX[country.numeric] = country.alpha_2
+
+    return ISO3166_1_INDEX
+
+
 def str_iso3166_1(arg: str):
-    country = None
-    if arg.isnumeric():
-        country = pycountry.countries.get(numeric=arg)
-    elif len(arg) == 2:
-        country = pycountry.countries.get(alpha_2=arg)
-    elif len(arg) == 3:
-        country = pycountry.countries.get(alpha_3=arg)
-    else:
-        print(arg)
+    if not (arg.isnumeric() or len(arg) in (2, 3)):
         msg = 'invalid ISO 3166-1 code format'
         raise configargparse.ArgumentTypeError(msg)
 
+    country = iso3166_1_index().get(arg.upper())
     if country is None:
         msg = f'"{arg}" unknown ISO 3166-1 code'
         raise configargparse.ArgumentTypeError(msg)
 
-    return country.alpha_2
+    return country
@@ -3,8 +3,10 @@
 
 import logging
 import queue
+import re
 import time
-from threading import Event, Thread
+from collections import deque
+from threading import Condition, Event, Thread
 
 from peewee import DatabaseProxy, DatabaseError, OperationalError
 from playhouse.pool import PooledMySQLDatabase, MaxConnectionsExceeded
@@ -15,6 +17,69 @@ from .models import Proxy, ProxyTest, DBConfig
 
 log = logging.getLogger(__name__)
 
+TABLE_COLLATION = 'utf8mb4_unicode_ci'
+TABLE_NAME_RE = re.compile(r'[A-Za-z0-9_]+')
+RETRY_BASE_DELAY = 0.5  # seconds
+RETRY_MAX_DELAY = 10.0  # seconds
+# MySQL errors raised when LOAD DATA LOCAL INFILE is disabled on the server
+LOAD_DATA_DISABLED_ERRORS = (1148, 3948)
+# Column order of the rows passed to `ProxyTest.bulk_load`
+PROXYTEST_LOAD_FIELDS = [ProxyTest.proxy, ProxyTest.status, ProxyTest.latency,
+                         ProxyTest.info, ProxyTest.created]
+
+
+def drain_queue(q: queue.Queue) -> list:
+    """ Remove all items from a queue while holding its lock only once """
+    with q.mutex:
+        items = list(q.queue)
+        q.queue.clear()
+        q.unfinished_tasks = 0
+        q.all_tasks_done.notify_all()
+        q.not_full.notify_all()
+    return items
+
+
+def retry_delay(error_count: int) -> float:
+    """ Exponential backoff between retries of failed database operations """
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (1 << error_count))
+
+
+class BoundedDeque:
+    """
+    Bounded multi-producer, single-consumer queue.
+    Lighter than `queue.Queue`: one lock, no task tracking, bulk drain.
+    """
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._deque = deque()
+        self._cond = Condition()
+
+    def qsize(self) -> int:
+        return len(self._deque)
+
+    def put(self, item, timeout=None) -> None:
+        """ Append an item, raises `queue.Full` if no room frees up in time """
+        with self._cond:
+            if len(self._deque) >= self.maxsize:
+                if not self._cond.wait_for(
+                        lambda: len(self._deque) < self.maxsize, timeout):
+                    raise queue.Full
+            self._deque.append(item)
+            # Producers only wait on a full queue, so this wakes the consumer
+            if len(self._deque) == 1:
+                self._cond.notify()
+
+    def drain(self, timeout=None) -> list:
+        """ Wait for items up to `timeout` seconds and remove all of them """
+        with self._cond:
+            if not self._deque and not self._cond.wait_for(
+                    lambda: self._deque, timeout):
+                return []
+            items = list(self._deque)
+            self._deque.clear()
+            self._cond.notify_all()
+        return items
+
 
 ###############################################################################
 # Database initialization
@@ -24,16 +89,19 @@ log = logging.getLogger(__name__)
 ###############################################################################
 class Database():
     BATCH_SIZE = 250  # TODO: move to Config argparse
+    LOAD_DATA_SIZE = 1000  # minimum batch size for LOAD DATA LOCAL INFILE
     DB = DatabaseProxy()
     MODELS = [Proxy, ProxyTest, DBConfig]
-    SCHEMA_VERSION = 1
+    SCHEMA_VERSION = 2
 
     def __init__(self):
         """ Create a pooled connection to MySQL database """
         self.args = Config.get_args()
+        self.table_names = ', '.join(m.__name__ for m in self.MODELS)
+        self.migrator = None
 
-        log.info('Connecting to MySQL database on '
-                 f'{self.args.db_host}:{self.args.db_port}...')
+        log.info('Connecting to MySQL database on %s:%s...',
+                 self.args.db_host, self.args.db_port)
 
         # https://docs.peewee-orm.com/en/latest/peewee/playhouse.html#pool-apis
         database = PooledMySQLDatabase(
@@ -43,6 +111,7 @@ class Database():
             user=self.args.db_user,
             password=self.args.db_pass,
             charset='utf8mb4',
+            local_infile=self.args.db_load_data,
             autoconnect=False,
             max_connections=self.args.db_max_conn,  # use None for unlimited
             stale_timeout=180,  # use None to disable
@@ -68,8 +137,7 @@ class Database():
     #  https://docs.peewee-orm.com/en/latest/peewee/api.html#Database.create_tables
     def create_tables(self):
         """ Create tables in the database (skips existing) """
-        table_names = ', '.join([m.__name__ for m in self.MODELS])
-        log.info('Creating database tables: %s', table_names)
+        log.info('Creating database tables: %s', self.table_names)
         self.DB.create_tables(self.MODELS, safe=True)  # safe adds if not exists
         # Create schema version key
         DBConfig.insert_schema_version(self.SCHEMA_VERSION)
@@ -78,8 +146,7 @@ class Database():
     #  https://docs.peewee-orm.com/en/latest/peewee/api.html#Database.drop_tables
     def drop_tables(self):
         """ Drop all the tables in the database """
-        table_names = ', '.join([m.__name__ for m in self.MODELS])
-        log.info('Dropping database tables: %s', table_names)
+        log.info('Dropping database tables: %s', self.table_names)
         self.DB.execute_sql('SET FOREIGN_KEY_CHECKS=0;')
         self.DB.drop_tables(self.MODELS, safe=True)
         self.DB.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
@@ -88,11 +155,14 @@ class Database():
     # https://docs.peewee-orm.com/en/latest/peewee/playhouse.html#schema-migrations
     def migrate_database_schema(self, old_ver):
         """ Migrate database schema """
-        log.info(f'Migrating schema version {old_ver} to {self.SCHEMA_VERSION}.')
-        migrator = MySQLMigrator(self.DB)
+        log.info('Migrating schema version %s to %s.', old_ver, self.SCHEMA_VERSION)
+        if self.migrator is None:
+            self.migrator = MySQLMigrator(self.DB)
+        migrator = self.migrator
 
         if old_ver < 2:
-            migrate(migrator.rename_table('db_config', 'db_config'))
+            # Token used to claim proxies for testing
+            migrate(migrator.add_column('proxy', 'lock_token', Proxy.lock_token))
 
         log.info('Schema migration complete.')
 
@@ -116,34 +186,40 @@ class Database():
 
     def verify_table_encoding(self):
         """ Verify if table collation is valid """
-        change_tables = self.DB.execute_sql(
-            'SELECT table_name FROM information_schema.tables WHERE '
-            'table_collation != "utf8mb4_unicode_ci" '
-            f'AND table_schema = "{self.args.db_name}";')
-
-        tables = self.DB.execute_sql('SHOW tables;')
-
-        if change_tables.rowcount > 0:
-            log.info('Changing collation and charset on '
-                     f'{change_tables.rowcount} tables.')
-
-            if change_tables.rowcount == tables.rowcount:
+        # Single round trip for both table list and collations
+        cursor = self.DB.execute_sql(
+            'SELECT table_name, table_collation FROM information_schema.tables '
+            'WHERE table_schema = %s;', (self.args.db_name,))
+        tables = cursor.fetchall()
+        change_tables = [name for name, collation in tables
+                         if collation != TABLE_COLLATION]
+
+        # Table names cannot be bound as parameters, only allow plain identifiers
+        for table in change_tables:
+            if not TABLE_NAME_RE.fullmatch(table):
+                raise RuntimeError(f'Invalid table name: {table!r}')
+
+        if change_tables:
+            log.info('Changing collation and charset on %d tables.',
+                     len(change_tables))
+
+            if len(change_tables) == len(tables):
                 log.info('Changing whole database, this might a take while.')
 
-            self.DB.execute_sql('SET FOREIGN_KEY_CHECKS=0;')
-            for table in change_tables:
-                log.debug('Changing collation and charset on '
-                          f'table {table[0]}.')
-                self.DB.execute_sql(
-                    f'ALTER TABLE {table[0]} CONVERT TO '
-                    'CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;')
-            self.DB.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
+            with self.DB.atomic():
+                self.DB.execute_sql('SET FOREIGN_KEY_CHECKS=0;')
+                for table in change_tables:
+                    log.debug('Changing collation and charset on table %s.', table)
+                    self.DB.execute_sql(
+                        f'ALTER TABLE `{table}` CONVERT TO '
+                        f'CHARACTER SET utf8mb4 COLLATE {TABLE_COLLATION};')
+                self.DB.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
 
     def print_stats(self):
         in_use = len(self.DB._in_use)
         available = len(self.DB._connections)
-        log.info('Database connections: '
-                 f'{in_use} in use and {available} available.')
+        log.info('Database connections: %d in use and %d available.',
+                 in_use, available)
 
 
 class InsertProxyThread(Thread):
@@ -156,28 +232,27 @@ class InsertProxyThread(Thread):
         self.queue = queue.Queue()
 
     def print_stats(self):
-        log.info(
-            f'Insert Proxy Queue: {self.queue.qsize()} '
-            f'(backlog: {len(self.backlog)})')
+        log.info('Insert Proxy Queue: %d lists (backlog: %d)',
+                 self.queue.qsize(), len(self.backlog))
 
     def put(self, proxy: Proxy):
-        self.queue.put(proxy, block=False)
+        self.queue.put([proxy], block=False)
 
     def put_list(self, proxylist: list):
-        for proxy in proxylist:
-            self.queue.put(proxy, block=False)
+        # Queue whole scrapped lists, they are flushed in batches
+        if proxylist:
+            self.queue.put(proxylist, block=False)
 
     def update_db(self):
         if self.queue.qsize() + len(self.backlog) < 1:
             time.sleep(1.0)
             return True
 
-        while not self.queue.empty():
-            proxy = self.queue.get(block=False)
-            self.backlog.append(proxy)
+        for proxylist in drain_queue(self.queue):
+            self.backlog.extend(proxylist)
 
         try:
-            Proxy.database().connect()
+            Proxy.database().connect(reuse_if_open=True)
             row_count = 0
             with Proxy.database().atomic():
                 for idx in range(0, len(self.backlog), Database.BATCH_SIZE):
@@ -192,14 +267,16 @@ class InsertProxyThread(Thread):
                                 ]))
                     row_count += query.as_rowcount().execute()
 
-            log.debug(f'Inserted {len(self.backlog)} proxies.')
+            log.debug('Inserted %d proxies.', len(self.backlog))
             self.backlog.clear()
             return True
         except DatabaseError as e:
-            log.warning(f'Failed to insert proxies: {e}')
+            log.warning('Failed to insert proxies: %s', e)
+            Proxy.database().manual_close()
         except MaxConnectionsExceeded as e:
-            log.warning(f'Failed to acquire a database connection: {e}')
+            log.warning('Failed to acquire a database connection: %s', e)
         finally:
+            # Idle until the next proxylist refresh, return the connection to the pool
             Proxy.database().close()
 
         return False
@@ -207,6 +284,8 @@ class InsertProxyThread(Thread):
     def run(self) -> None:
         log.debug('Proxy insert thread started.')
         error_count = 0
+        interrupt_is_set = self.interrupt.is_set
+        update_db = self.update_db
         while True:
             if error_count > 4:
                 log.error('Unable to insert proxies.')
@@ -214,18 +293,19 @@ class InsertProxyThread(Thread):
                 break
 
             try:
-                if not self.update_db():
+                if not update_db():
                     error_count += 1
-                    time.sleep(1.0 * error_count)
+                    time.sleep(retry_delay(error_count))
                     continue
             except Exception as e:
-                log.exception(f'Exception caught: {e}')
+                log.exception('Exception caught: %s', e)
 
             error_count = 0
-            if self.interrupt.is_set():
+            if interrupt_is_set():
                 break
 
         self.update_db()
+        Proxy.database().close()
         log.debug('Proxy insert thread shutdown.')
 
 
@@ -236,95 +316,128 @@ class TestingThread(Thread):
         self.args = db_queue.args
         self.interrupt = db_queue.interrupt
         self.queue = queue.Queue(maxsize=self.args.manager_testers * 2)
+        # Signaled by testers when the queue drops to the refill watermark
+        self.refill = Condition()
+        self.refill_watermark = self.queue.maxsize // 2
+        self.fill_count = 0
+        self.queue_full = False
+        # Protocol filter for proxies to test (empty: all)
+        protocol = self.args.proxy_protocol_value
+        self.protocols = [] if protocol is None else [protocol]
+        # Resolved on first fill, requires an open connection
+        self.skip_locked = None
 
     def print_stats(self):
-        log.info(f'Testing Queue: {self.queue.qsize()}')
+        log.info('Testing Queue: %d', self.queue.qsize())
 
     def free_slots(self):
         return self.queue.maxsize - self.queue.qsize()
 
+    def needs_refill(self):
+        return self.queue.qsize() <= self.refill_watermark
+
     def get_proxy(self) -> Proxy:
         try:
             proxy = self.queue.get(timeout=1)
-            return proxy
         except queue.Empty:
             return None
 
+        if self.needs_refill():
+            with self.refill:
+                self.refill.notify()
+        return proxy
+
+    @staticmethod
+    def supports_skip_locked(version) -> bool:
+        """ SKIP LOCKED is available on MySQL 8.0.1+ and MariaDB 10.6+ """
+        return version >= (10, 6) or (8, 0, 1) <= version < (10,)
+
     def fill_queue(self):
-        protocol = self.args.proxy_protocol
+        self.fill_count = 0
         free_slots = self.queue.maxsize - self.queue.qsize()
-        if free_slots == 0:
-            time.sleep(1.0)
-            return True
-
-        if not self.db_queue.lock_database():
-            time.sleep(1.0)
+        self.queue_full = free_slots == 0
+        if self.queue_full:
             return True
 
         try:
-            Proxy.database().connect()
-            query = Proxy.need_scan(limit=free_slots, protocols=protocol)
-            proxy_ids = []
-            for proxy in query:
-                proxy_ids.append(proxy.id)
-                self.queue.put(proxy)
-            Proxy.bulk_lock(proxy_ids)
+            Proxy.database().connect(reuse_if_open=True)
+            if self.skip_locked is None:
+                version = Proxy.database().server_version or (0,)
+                self.skip_locked = self.supports_skip_locked(version)
+                log.debug('Claiming proxies with SKIP LOCKED: %s', self.skip_locked)
+
+            if self.skip_locked:
+                proxies = Proxy.claim_for_scan(limit=free_slots, protocols=self.protocols)
+            else:
+                proxies = Proxy.claim_by_token(limit=free_slots, protocols=self.protocols)
+
+            put = self.queue.put
+            for proxy in proxies:
+                put(proxy)
+            self.fill_count = len(proxies)
             return True
         except DatabaseError as e:
-            log.warning(f'Failed to fill test queue: {e}')
+            log.warning('Failed to fill test queue: %s', e)
+            Proxy.database().manual_close()
         except MaxConnectionsExceeded as e:
-            log.warning(f'Failed to acquire a database connection: {e}')
-        finally:
-            self.db_queue.unlock_database()
-            Proxy.database().close()
+            log.warning('Failed to acquire a database connection: %s', e)
 
         return False
 
     def release_queue(self):
-        proxy_ids = []
-        while not self.queue.empty():
-            proxy = self.queue.get(block=False)
-            proxy_ids.append(proxy.id)
+        proxy_ids = [proxy.id for proxy in drain_queue(self.queue)]
 
         try:
-            Proxy.database().connect()
+            Proxy.database().connect(reuse_if_open=True)
             row_count = Proxy.bulk_unlock(proxy_ids)
-            log.debug(f'Released {row_count} proxies from testing.')
+            log.debug('Released %d proxies from testing.', row_count)
             return True
         except DatabaseError as e:
-            log.error(f'Failed to release testing queue: {e}')
+            log.error('Failed to release testing queue: %s', e)
+            Proxy.database().manual_close()
         except MaxConnectionsExceeded as e:
-            log.error(f'Failed to acquire a database connection: {e}')
-        finally:
-            Proxy.database().close()
+            log.error('Failed to acquire a database connection: %s', e)
 
-        log.warning(f'Failed to release {len(proxy_ids)} proxies.')
+        log.warning('Failed to release %d proxies.', len(proxy_ids))
         return False
 
     def run(self) -> None:
         log.debug('Test queue thread started.')
         error_count = 0
+        interrupt_is_set = self.interrupt.is_set
+        fill_queue = self.fill_queue
+        wait = self.interrupt.wait
         while True:
             if error_count > 4:
                 log.error('Unable to get proxies to test.')
                 self.interrupt.set()
                 break
 
-            if self.interrupt.is_set():
+            if interrupt_is_set():
                 break
 
             try:
-                if not self.fill_queue():
+                if not fill_queue():
                     error_count += 1
-                    time.sleep(1.0 * error_count)
+                    time.sleep(retry_delay(error_count))
                     continue
             except Exception as e:
-                log.exception(f'Exception caught: {e}')
+                log.exception('Exception caught: %s', e)
 
             error_count = 0
-            time.sleep(5.0)
+            if self.fill_count == 0 and not self.queue_full:
+                # Nothing to claim: no proxies due for a scan
+                wait(5.0)
+                continue
+
+            # Wait until testers drain the queue down to the watermark
+            with self.refill:
+                self.refill.wait_for(
+                    lambda: self.needs_refill() or interrupt_is_set(),
+                    timeout=5.0)
 
         self.release_queue()
+        Proxy.database().close()
         log.debug('Test queue thread shutdown.')
 
 
@@ -334,80 +447,74 @@ class UpdateProxyThread(Thread):
         self.db_queue = db_queue
         self.args = db_queue.args
         self.interrupt = db_queue.interrupt
-        self.threshold = threshold
         self.backlog = []
         self.queue = queue.Queue(maxsize=self.args.manager_testers * 10)
+        # Clamp once, batch size can't exceed queue capacity
+        self.threshold = max(1, min(self.queue.maxsize - 1, threshold))
 
     def print_stats(self):
-        log.info(
-            f'Update Proxy Queue: {self.queue.qsize()} '
-            f'(backlog: {len(self.backlog)})')
+        log.info('Update Proxy Queue: %d (backlog: %d)',
+                 self.queue.qsize(), len(self.backlog))
 
     def put(self, proxy: Proxy):
         self.queue.put(proxy, timeout=1)
 
-    def update_db(self, threshold=0):
-        threshold = min(self.queue.maxsize-1, threshold)
-        if self.queue.qsize() + len(self.backlog) < threshold:
-            time.sleep(1.0)
-            return True
+    def fill_backlog(self):
+        """ Wait briefly for queued items, then drain the queue without blocking """
+        try:
+            self.backlog.append(self.queue.get(timeout=1.0))
+        except queue.Empty:
+            return
 
-        while not self.queue.empty():
-            proxy = self.queue.get(block=False)
-            self.backlog.append(proxy)
+        self.backlog.extend(drain_queue(self.queue))
+
+    def update_db(self, threshold=1):
+        self.fill_backlog()
+        if len(self.backlog) < threshold:
+            return True
 
         try:
-            Proxy.database().connect()
+            Proxy.database().connect(reuse_if_open=True)
             with Proxy.database().atomic():
-                Proxy.bulk_update(
-                    self.backlog,
-                    fields=[
-                        'status',
-                        'latency',
-                        'test_count',
-                        'fail_count',
-                        'country',
-                        'modified'
-                    ],
-                    batch_size=Database.BATCH_SIZE)
-                self.backlog.clear()
-                return True
+                Proxy.bulk_update_tested(self.backlog, batch_size=Database.BATCH_SIZE)
+            self.backlog.clear()
+            return True
         except DatabaseError as e:
-            log.warning(f'Failed to update Proxy queue: {e}')
+            log.warning('Failed to update Proxy queue: %s', e)
+            Proxy.database().manual_close()
         except MaxConnectionsExceeded as e:
-            log.warning(f'Failed to acquire a database connection: {e}')
-        finally:
-            Proxy.database().close()
+            log.warning('Failed to acquire a database connection: %s', e)
 
         return False
 
     def run(self) -> None:
         log.debug('Proxy update thread started.')
         error_count = 0
+        interrupt_is_set = self.interrupt.is_set
+        update_db = self.update_db
         while True:
             if error_count > 4:
                 log.error('Unable to update Proxy queue.')
                 self.interrupt.set()
                 break
 
-            if self.interrupt.is_set():
-                threshold = 0
-            else:
-                threshold = self.threshold
+            # Flush everything on shutdown
+            threshold = 1 if interrupt_is_set() else self.threshold
 
             try:
-                if not self.update_db(threshold):
+                if not update_db(threshold):
                     error_count += 1
-                    time.sleep(1.0 * error_count)
+                    time.sleep(retry_delay(error_count))
                     continue
             except Exception as e:
-                log.exception(f'Exception caught: {e}')
+                log.exception('Exception caught: %s', e)
 
             error_count = 0
-            if self.interrupt.is_set():
+            if interrupt_is_set():
                 break
 
         self.update_db()
+        Proxy.database().close()
         log.debug('Proxy update thread shutdown.')
 
 
@@ -417,72 +524,95 @@ class UpdateProxyTestThread(Thread):
         self.db_queue = db_queue
         self.args = db_queue.args
         self.interrupt = db_queue.interrupt
-        self.threshold = threshold
         self.backlog = []
-        self.queue = queue.Queue(maxsize=self.args.manager_testers * 50)
+        # Hottest queue (one entry per test), avoid `queue.Queue` overhead
+        self.queue = BoundedDeque(maxsize=self.args.manager_testers * 50)
+        # Clamp once, batch size can't exceed queue capacity
+        self.threshold = max(1, min(self.queue.maxsize - 1, threshold))
+        # Disabled if the server rejects LOAD DATA LOCAL INFILE
+        self.load_data = self.args.db_load_data
 
     def print_stats(self):
-        log.info(
-            f'Update ProxyTest Queue: {self.queue.qsize()} '
-            f'(backlog: {len(self.backlog)})')
+        log.info('Update ProxyTest Queue: %d (backlog: %d)',
+                 self.queue.qsize(), len(self.backlog))
 
     def put(self, proxytest: ProxyTest):
         self.queue.put(proxytest, timeout=1)
 
-    def update_db(self, threshold=0):
-        threshold = min(self.queue.maxsize-1, threshold)
-        if self.queue.qsize() + len(self.backlog) < threshold:
-            time.sleep(1.0)
-            return True
+    def fill_backlog(self):
+        """ Wait briefly for queued items, then drain the queue """
+        self.backlog.extend(self.queue.drain(timeout=1.0))
 
-        while not self.queue.empty():
-            proxy = self.queue.get(block=False)
-            self.backlog.append(proxy)
+    def load_backlog(self):
+        """ Insert backlog with LOAD DATA LOCAL INFILE, False if unavailable """
+        rows = ((proxytest.proxy_id, proxytest.status, proxytest.latency,
+                 proxytest.info, proxytest.created) for proxytest in self.backlog)
+        try:
+            ProxyTest.bulk_load(rows, PROXYTEST_LOAD_FIELDS)
+            return True
+        except OperationalError as e:
+            # peewee re-raises driver errors, error code is in the original
+            error = e.__context__ or e
+            if error.args and error.args[0] in LOAD_DATA_DISABLED_ERRORS:
+                log.warning('LOAD DATA LOCAL INFILE rejected, '
+                            'falling back to batched inserts: %s', e)
+                self.load_data = False
+                return False
+            raise
+
+    def update_db(self, threshold=1):
+        self.fill_backlog()
+        if len(self.backlog) < threshold:
+            return True
 
         try:
-            ProxyTest.database().connect()
-            with ProxyTest.database().atomic():
-                ProxyTest.bulk_create(
-                    self.backlog,
-                    batch_size=Database.BATCH_SIZE)
-                self.backlog.clear()
-                return True
+            ProxyTest.database().connect(reuse_if_open=True)
+            loaded = (self.load_data and
+                      len(self.backlog) >= Database.LOAD_DATA_SIZE and
+                      self.load_backlog())
+            if not loaded:
+                with ProxyTest.database().atomic():
+                    ProxyTest.bulk_create(
+                        self.backlog,
+                        batch_size=Database.BATCH_SIZE)
+            self.backlog.clear()
+            return True
         except DatabaseError as e:
-            log.warning(f'Failed to update ProxyTest queue: {e}')
+            log.warning('Failed to update ProxyTest queue: %s', e)
+            ProxyTest.database().manual_close()
         except MaxConnectionsExceeded as e:
-            log.warning(f'Failed to acquire a database connection: {e}')
-        finally:
-            ProxyTest.database().close()
+            log.warning('Failed to acquire a database connection: %s', e)
 
         return False
 
     def run(self) -> None:
         log.debug('ProxyTest update thread started.')
         error_count = 0
+        interrupt_is_set = self.interrupt.is_set
+        update_db = self.update_db
         while True:
             if error_count > 4:
                 log.error('Unable to update ProxyTest queue.')
                 self.interrupt.set()
                 break
 
-            if self.interrupt.is_set():
-                threshold = 0
-            else:
-                threshold = self.threshold
+            # Flush everything on shutdown
+            threshold = 1 if interrupt_is_set() else self.threshold
 
             try:
-                if not self.update_db(threshold):
+                if not update_db(threshold):
                     error_count += 1
-                    time.sleep(1.0 * error_count)
+                    time.sleep(retry_delay(error_count))
                     continue
             except Exception as e:
-                log.exception(f'Exception caught: {e}')
+                log.exception('Exception caught: %s', e)
 
             error_count = 0
-            if self.interrupt.is_set():
+            if interrupt_is_set():
                 break
 
         self.update_db()
+        ProxyTest.database().close()
         log.debug('ProxyTest update thread shutdown.')
 
 
@@ -497,10 +627,10 @@ class CleanupThread(Thread):
         try:
             row_count = Proxy.unlock_stuck()
             if row_count > 0:
-                log.debug(f'Unlocked {row_count} proxies stuck in testing.')
+                log.debug('Unlocked %d proxies stuck in testing.', row_count)
             return True
         except DatabaseError as e:
-            log.warning(f'Failed to delete bad proxies: {e}')
+            log.warning('Failed to unlock stuck proxies: %s', e)
 
         return False
 
@@ -510,7 +640,7 @@ class CleanupThread(Thread):
             return True
 
         try:
-            Proxy.database().connect()
+            Proxy.database().connect(reuse_if_open=True)
             self.unlock_stuck()
             row_count = Proxy.delete_failed(
                 age_days=self.args.cleanup_age,
@@ -518,41 +648,49 @@ class CleanupThread(Thread):
                 fail_ratio=self.args.cleanup_fail_ratio,
                 limit=100)
             if row_count > 0:
-                log.debug(f'Deleted {row_count} bad proxies.')
+                log.debug('Deleted %d bad proxies.', row_count)
             return True
         except DatabaseError as e:
-            log.warning(f'Failed to delete bad proxies: {e}')
+            log.warning('Failed to delete bad proxies: %s', e)
+            Proxy.database().manual_close()
         except MaxConnectionsExceeded as e:
-            log.warning(f'Failed to acquire a database connection: {e}')
+            log.warning('Failed to acquire a database connection: %s', e)
         finally:
             self.db_queue.unlock_database()
-            Proxy.database().close()
 
         return False
 
     def run(self) -> None:
         log.debug('Cleanup thread started.')
         error_count = 0
+        interrupt_is_set = self.interrupt.is_set
+        update_db = self.update_db
+        wait = self.interrupt.wait
+        close = Proxy.database().close
         while True:
             if error_count > 4:
                 log.error('Unable to cleanup database.')
                 self.interrupt.set()
                 break
 
-            if self.interrupt.is_set():
+            if interrupt_is_set():
                 break
 
             try:
-                if not self.update_db():
+                if not update_db():
                     error_count += 1
-                    time.sleep(1.0 * error_count)
+                    time.sleep(retry_delay(error_count))
                     continue
             except Exception as e:
-                log.exception(f'Exception caught: {e}')
+                log.exception('Exception caught: %s', e)
 
             error_count = 0
-            time.sleep(30.0)
+            # Idle most of the time, return the connection to the pool meanwhile
+            close()
+            # Wake up immediately on shutdown instead of delaying join()
+            wait(30.0)
 
+        close()
         log.debug('Cleanup thread shutdown.')
 
 
@@ -609,11 +747,10 @@ class DatabaseQueue():
             DBConfig.database().connect(reuse_if_open=True)
             return DBConfig.lock_database(self.args.hash)
         except DatabaseError as e:
-            log.error(f'Failed to lock database: {e}')
+            log.error('Failed to lock database: %s', e)
+            DBConfig.database().manual_close()
         except MaxConnectionsExceeded as e:
-            log.error(f'Failed to acquire a database connection: {e}')
-        finally:
-            ProxyTest.database().close()
+            log.error('Failed to acquire a database connection: %s', e)
         return False
 
     def unlock_database(self):
@@ -621,11 +758,10 @@ class DatabaseQueue():
             DBConfig.database().connect(reuse_if_open=True)
             return DBConfig.unlock_database(self.args.hash)
         except DatabaseError as e:
-            log.error(f'Failed to unlock database: {e}')
+            log.error('Failed to unlock database: %s', e)
+            DBConfig.database().manual_close()
         except MaxConnectionsExceeded as e:
-            log.error(f'Failed to acquire a database connection: {e}')
-        finally:
-            ProxyTest.database().close()
+            log.error('Failed to acquire a database connection: %s', e)
         return False
 
     def insert_proxylist(self, proxylist):
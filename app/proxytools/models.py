@@ -2,9 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import os
+import secrets
+import tempfile
 
 from peewee import (
-    fn, JOIN, Case, OperationalError, IntegrityError,
+    fn, chunked, JOIN, SQL, Case, OperationalError, IntegrityError,
     Model, ModelSelect, ModelUpdate, ModelDelete,
     ForeignKeyField, BigAutoField, DateTimeField, CharField,
     IntegerField, BigIntegerField, SmallIntegerField, IPField)
@@ -21,6 +24,13 @@ class ProxyProtocol(IntEnum):
     SOCKS5 = 2
 
 
+# Protocol names accepted on the command line
+PROTOCOL_NAMES = tuple(protocol.name for protocol in ProxyProtocol)
+
+# Lowercase protocol names used as URL schemes, keyed by protocol value
+PROTOCOL_SCHEMES = {protocol: protocol.name.lower() for protocol in ProxyProtocol}
+
+
 class ProxyStatus(IntEnum):
     UNKNOWN = 0
     TESTING = 1
@@ -62,7 +72,8 @@ class IntEnumField(SmallIntegerField):
         self.choices = choices
 
     def db_value(self, value):
-        return value.value
+        # Accept enum members and plain integers alike
+        return value if value is None else int(value)
 
     def python_value(self, value):
         return self.choices(value)
@@ -84,6 +95,11 @@ class BaseModel(Model):
     def get_all(cls):
         return [m for m in cls.select().dicts()]
 
+    @classmethod
+    def row_count(cls) -> int:
+        """ Count table rows with a plain COUNT(*), without wrapping a subquery """
+        return cls.select(fn.COUNT(SQL('*'))).scalar()
+
     @classmethod
     def get_random(cls, limit=1):
         return cls.select().order_by(fn.Rand()).limit(limit)
@@ -103,6 +119,7 @@ class Proxy(BaseModel):
     country = Utf8mb4CharField(index=True, null=True, max_length=2)
     created = DateTimeField(index=True, default=datetime.utcnow)
     modified = DateTimeField(index=True, default=datetime.utcnow)
+    lock_token = Utf8mb4CharField(index=True, null=True, max_length=32)
 
     class Meta:
         indexes = (
@@ -145,16 +162,9 @@ class Proxy(BaseModel):
         Returns:
             string: Proxy URL
         """
-        url = f"{self.ip}:{self.port}"
-
-        if self.username and self.password:
-            url = f"{self.username}:{self.password}@{url}"
-
-        if not no_protocol:
-            protocol = ProxyProtocol(self.protocol).name.lower()
-            url = f"{protocol}://{url}"
-
-        return url
+        return Proxy.url_format(
+            self.ip, self.port, self.protocol,
+            self.username, self.password, no_protocol)
 
     def url_proxychains(self):
         """
@@ -164,14 +174,41 @@ class Proxy(BaseModel):
         Returns:
             string: ProxyChains formatted proxy URL
         """
-        url = f"{self.ip} {self.port}"
-        if self.username and self.password:
-            url = f"{url} {self.username} {self.password}"
+        return Proxy.url_proxychains_format(
+            self.ip, self.port, self.protocol,
+            self.username, self.password)
+
+    @staticmethod
+    def url_format(ip, port, protocol, username=None, password=None,
+                   no_protocol=False) -> str:
+        """
+        Build a URL string from raw proxy columns, e.g. rows from `get_valid_url_parts`.
+
+        Returns:
+            string: Proxy URL
+        """
+        if username and password:
+            url = f"{username}:{password}@{ip}:{port}"
+        else:
+            url = f"{ip}:{port}"
+
+        if no_protocol:
+            return url
+
+        return f"{PROTOCOL_SCHEMES[protocol]}://{url}"
+
+    @staticmethod
+    def url_proxychains_format(ip, port, protocol, username=None, password=None) -> str:
+        """
+        Build a proxychains URL string from raw proxy columns.
 
-        protocol = self.protocol.name.lower()
-        url = f"{protocol} {url}"
+        Returns:
+            string: ProxyChains formatted proxy URL
+        """
+        if username and password:
+            return f"{PROTOCOL_SCHEMES[protocol]} {ip} {port} {username} {password}"
 
-        return url
+        return f"{PROTOCOL_SCHEMES[protocol]} {ip} {port}"
 
     @staticmethod
     def latest_tests(limit=1000) -> ModelSelect:
@@ -195,7 +232,9 @@ class Proxy(BaseModel):
 
         return query
 
-    def need_scan(limit=1000, age_secs=3600, protocols=[]):
+    @staticmethod
+    def scan_conditions(age_secs=3600, protocols=[]):
+        """ Filter proxies due for a scan """
         min_age = datetime.utcnow() - timedelta(seconds=age_secs)
         conditions = (
             (Proxy.modified < min_age) &
@@ -204,9 +243,12 @@ class Proxy(BaseModel):
         if protocols:
             conditions &= (Proxy.protocol << protocols)
 
+        return conditions
+
+    def need_scan(limit=1000, age_secs=3600, protocols=[]):
         query = (Proxy
                  .select(Proxy)
-                 .where(conditions)
+                 .where(Proxy.scan_conditions(age_secs, protocols))
                  .order_by(Proxy.status.asc(),  # lower status first
                            Proxy.modified.asc())  # older records first
                  .limit(limit))
@@ -252,7 +294,8 @@ class Proxy(BaseModel):
         proxy_test = self.latest_test()
 
         query = (Proxy
-                 .update(status=proxy_test.status, modified=proxy_test.created)
+                 .update(status=proxy_test.status, modified=proxy_test.created,
+                         lock_token=None)
                  .where(Proxy.id == self.id))
 
         return query.execute()
@@ -269,6 +312,99 @@ class Proxy(BaseModel):
 
         return query.execute()
 
+    @staticmethod
+    def claim_for_scan(limit=1000, age_secs=3600, protocols=[]):
+        """
+        Select and lock proxies to testing status in a single transaction.
+        Rows being claimed by other scanners are skipped instead of waited on,
+        so concurrent scanners get disjoint sets without a global lock.
+        Requires MySQL 8.0.1+ or MariaDB 10.6+ (SKIP LOCKED).
+
+        Returns:
+            list[Proxy]: claimed proxies
+        """
+        query = (Proxy
+                 .need_scan(limit=limit, age_secs=age_secs, protocols=protocols)
+                 .for_update('FOR UPDATE SKIP LOCKED'))
+
+        with Proxy.database().atomic():
+            proxies = list(query)
+            if proxies:
+                Proxy.bulk_lock([proxy.id for proxy in proxies])
+
+        return proxies
+
+    @staticmethod
+    def claim_by_token(limit=1000, age_secs=3600, protocols=[]):
+        """
+        Lock proxies to testing status with a single UPDATE ... LIMIT that
+        tags claimed rows with a random token, then fetch them by token.
+        Statement is atomic, no global lock needed to avoid double claims.
+
+        Returns:
+            list[Proxy]: claimed proxies
+        """
+        token = secrets.token_hex(16)
+
+        row_count = (Proxy
+                     .update(status=ProxyStatus.TESTING,
+                             modified=datetime.utcnow(),
+                             lock_token=token)
+                     .where(Proxy.scan_conditions(age_secs, protocols))
+                     .order_by(Proxy.status.asc(),  # lower status first
+                               Proxy.modified.asc())  # older records first
+                     .limit(limit)
+                     .execute())
+
+        if not row_count:
+            return []
+
+        return list(Proxy.select(Proxy).where(Proxy.lock_token == token))
+
+    @staticmethod
+    def bulk_update_tested(proxies, batch_size=250):
+        """
+        Write test results with one UPDATE ... JOIN per batch against a
+        derived table of new values, instead of a CASE expression per field.
+        Only existing rows are updated, proxies deleted meanwhile stay deleted.
+        Country is only filled in when missing, as testers do.
+        Clears the `lock_token` set when the proxy was claimed.
+
+        Args:
+            proxies (list[Proxy]): proxy model instances with test results
+            batch_size (int, optional): rows per statement. Defaults to 250.
+
+        Returns:
+            int count: updated proxy count
+        """
+        # Columns changed by proxy testers
+        fields = [
+            Proxy.id, Proxy.status, Proxy.latency, Proxy.test_count,
+            Proxy.fail_count, Proxy.country, Proxy.modified
+        ]
+        columns = [field.column_name for field in fields]
+        first_row = 'SELECT ' + ', '.join(f'%s AS `{column}`' for column in columns)
+        next_row = 'SELECT ' + ', '.join(['%s'] * len(columns))
+        assignments = ', '.join(
+            f'p.`{column}` = COALESCE(p.`{column}`, v.`{column}`)'
+            if column == Proxy.country.column_name else f'p.`{column}` = v.`{column}`'
+            for column in columns[1:])
+        # Release the claim token along with the test results
+        assignments += f', p.`{Proxy.lock_token.column_name}` = NULL'
+
+        row_count = 0
+        for batch in chunked(proxies, batch_size):
+            values = ' UNION ALL '.join([first_row] + [next_row] * (len(batch) - 1))
+            params = [field.db_value(getattr(proxy, field.name))
+                      for proxy in batch for field in fields]
+            cursor = Proxy.database().execute_sql(
+                f'UPDATE `{Proxy._meta.table_name}` AS p '
+                f'JOIN ({values}) AS v ON p.`id` = v.`id` '
+                f'SET {assignments};', params)
+            row_count += cursor.rowcount
+
+        return row_count
+
     @staticmethod
     def bulk_unlock(proxy_ids):
         """
@@ -276,7 +412,7 @@ class Proxy(BaseModel):
         """
 
         query = (Proxy
-                 .update(status=ProxyStatus.UNKNOWN)
+                 .update(status=ProxyStatus.UNKNOWN, lock_token=None)
                  .where(Proxy.id << proxy_ids))
 
         return query.execute()
@@ -335,6 +471,13 @@ class Proxy(BaseModel):
                  .where(ProxyTest.proxy == self.id))
         return query
 
+    def test_id_bounds(self) -> tuple:
+        """ Retrieve the oldest and latest test IDs in a single query. """
+        query = (ProxyTest
+                 .select(fn.MIN(ProxyTest.id), fn.MAX(ProxyTest.id))
+                 .where(ProxyTest.proxy == self.id))
+        return query.scalar(as_tuple=True)
+
     @staticmethod
     def get_valid(limit=1000, age_secs=3600, protocol=None, exclude_countries=[]):
         """
@@ -353,7 +496,8 @@ class Proxy(BaseModel):
             (Proxy.modified > min_age) &
             (Proxy.status == ProxyStatus.OK))
 
-        if protocol:
+        # HTTP has value 0, check explicitly for None
+        if protocol is not None:
             conditions &= (Proxy.protocol == protocol)
 
         if exclude_countries:
@@ -369,6 +513,23 @@ class Proxy(BaseModel):
 
         return query
 
+    @staticmethod
+    def get_valid_url_parts(limit=1000, age_secs=3600, protocol=None, exclude_countries=[]):
+        """
+        Get valid proxies tested recently, selecting only the URL columns.
+        Rows are tuples: (ip, port, protocol, username, password).
+
+        Returns:
+            query: Tuples query with the same filters and ordering as `get_valid`.
+        """
+        query = (Proxy
+                 .get_valid(limit, age_secs, protocol, exclude_countries)
+                 .select(Proxy.ip, Proxy.port, Proxy.protocol,
+                         Proxy.username, Proxy.password)
+                 .tuples())
+
+        return query
+
     # https://docs.peewee-orm.com/en/latest/peewee/querying.html#inserting-rows-in-batches
     @staticmethod
     def bulk_insert(proxylist, batch_size=250):
@@ -421,7 +582,8 @@ class Proxy(BaseModel):
             (Proxy.status == ProxyStatus.TESTING))
 
         query = (Proxy
-                 .update(status=ProxyStatus.ERROR, modified=datetime.utcnow())
+                 .update(status=ProxyStatus.ERROR, modified=datetime.utcnow(),
+                         lock_token=None)
                  .where(conditions))
 
         return query.execute()
@@ -500,6 +662,48 @@ class ProxyTest(BaseModel):
     info = Utf8mb4CharField(null=True)
     created = DateTimeField(index=True, default=datetime.utcnow)
 
+    @staticmethod
+    def bulk_load(rows, fields) -> int:
+        """
+        Insert tests with LOAD DATA LOCAL INFILE, much cheaper than INSERT
+        for large batches since rows skip the SQL parser.
+        Requires `local_infile` enabled on both client and server.
+
+        Args:
+            rows (iterable[tuple]): row values ordered as `fields`
+            fields (list[Field]): ProxyTest fields, `created` defaults to now
+
+        Returns:
+            int: inserted row count
+        """
+        converters = [field.db_value for field in fields]
+        escape = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+        columns = ', '.join(field.column_name for field in fields)
+        # Identity check, field `==` builds a query expression
+        set_created = ('' if any(field is ProxyTest.created for field in fields)
+                       else ' SET created = UTC_TIMESTAMP()')
+
+        file = tempfile.NamedTemporaryFile(
+            'w', encoding='utf-8', suffix='.tsv', delete=False)
+        try:
+            with file:
+                for row in rows:
+                    values = (convert(value) for convert, value in zip(converters, row))
+                    file.write('\t'.join(
+                        '\\N' if value is None else str(value).translate(escape)
+                        for value in values))
+                    file.write('\n')
+
+            cursor = ProxyTest.database().execute_sql(
+                f"LOAD DATA LOCAL INFILE %s INTO TABLE `{ProxyTest._meta.table_name}` "
+                "CHARACTER SET utf8mb4 "
+                "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' "
+                f"({columns}){set_created};",
+                (file.name,))
+            return cursor.rowcount
+        finally:
+            os.remove(file.name)
+
     @staticmethod
     def latest(exclude_ids=[]):
         """ Retrieve latest tests """
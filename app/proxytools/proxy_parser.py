@@ -49,6 +49,7 @@ class ProxyParser():
             scrapper = scrapper_cls()
         except RuntimeError as e:
             log.debug(e)
+            return
         self.scrappers[scrapper.name] = scrapper
 
     def unregister_scrapper(self, scrapper: ProxyScrapper):
@@ -47,7 +47,7 @@ class ProxyTester(Thread):
         The proxy is locked for testing using its status.
         Test results are persited and proxy data updated.
         """
-        log.debug(f'{self.name} started.')
+        log.debug('%s started.', self.name)
         while True:
             # Check if work is interrupted
             if self.interrupt.is_set():
@@ -70,7 +70,7 @@ class ProxyTester(Thread):
             self.evaluate_results(proxy, results)
             self.db_queue.update_proxy(proxy)
 
-        log.debug(f'{self.name} shutdown.')
+        log.debug('%s shutdown.', self.name)
 
     def evaluate_results(self, proxy: Proxy, results: list) -> None:
         """
@@ -88,10 +88,16 @@ class ProxyTester(Thread):
         for proxy_test in results:
             total_latency += proxy_test.latency
 
+        # Token claims reload proxies as TESTING, their previous status is unknown
+        previous_status = proxy.status
         proxy.latency = int(total_latency / len(results))
         proxy.status = results[-1].status
         proxy.modified = datetime.utcnow()
-        # log.debug(f'Tested Proxy #{proxy.id}: {proxy_test.info} - {proxy.latency}ms')
+        # Valid proxy set changes when a proxy enters or may have left OK status
+        if (proxy.status == ProxyStatus.OK or
+                previous_status in (ProxyStatus.OK, ProxyStatus.TESTING)):
+            self.manager.dirty.set()
+        # log.debug('Tested Proxy #%s: %s - %sms', proxy.id, proxy_test.info, proxy.latency)
 
     def update_stats(self, proxy: Proxy, proxy_test: ProxyTest) -> None:
         """
@@ -117,7 +123,7 @@ class ProxyTester(Thread):
                     log.debug('Skipped %s test for proxy: %s', test.name, proxy.url())
                     continue
 
-                # log.debug(f'Running test {test.name} on Proxy #{proxy.id}: {proxy.url()}')
+                # log.debug('Running test %s on Proxy #%s: %s', test.name, proxy.id, proxy.url())
                 proxy_test = test.run(proxy)
                 if not proxy_test:
                     log.error('Proxy test %s returned no results.', test_name)
@@ -30,6 +30,8 @@ class TestManager():
     def __init__(self):
         self.args = Config.get_args()
         self.interrupt = Event()
+        # Set when a proxy is found working since the last proxylist output
+        self.dirty = Event()
         self.stats_lock = Lock()
         self.ip2location = IP2LocationDatabase(self.args)
 
@@ -3,11 +3,11 @@
 
 import logging
 import os
-import random
 import re
 import socket
 import struct
 import sys
+import tempfile
 import time
 
 from timeit import default_timer as timer
@@ -26,6 +26,10 @@ class LogFilter(logging.Filter):
 
 
 def configure_logging(log, verbosity=0, output_path='logs', output_name='-app'):
+    # Skip collecting record attributes that are never logged
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
     date = time.strftime('%Y%m%d_%H%M')
     filename = os.path.join(output_path, '{}{}.log'.format(date, output_name))
     filelog = logging.FileHandler(filename)
@@ -56,7 +60,7 @@ def configure_logging(log, verbosity=0, output_path='logs', output_name='-app'):
     elif verbosity > 0:
         log.setLevel(logging.DEBUG)
         arg_str = 'v' * verbosity
-        log.info(f'Running in verbose mode (-{arg_str}).')
+        log.info('Running in verbose mode (-%s).', arg_str)
 
     if verbosity < 2:
         logging.getLogger('socks').setLevel(logging.INFO)
@@ -73,10 +77,6 @@ def configure_logging(log, verbosity=0, output_path='logs', output_name='-app'):
         start_monitoring()
 
 
-def sigterm_handler(_signo, _stack_frame):
-    sys.exit(0)
-
-
 def load_file(filename):
     lines = []
 
@@ -95,13 +95,28 @@ def load_file(filename):
 
 
 def export_file(filename, content):
-    with open(filename, 'w', encoding='utf-8') as file:
-        file.truncate()
-        if isinstance(content, list):
-            for line in content:
-                file.write(line + '\n')
-        else:
-            file.write(content)
+    """
+    Write a string or an iterable of lines to `filename`.
+    Content goes to a unique temporary file that atomically replaces `filename`,
+    so readers never see a partially written file.
+    """
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(filename) or '.', suffix='.tmp')
+    try:
+        # `mkstemp` creates owner-only files, keep outputs readable as before
+        os.chmod(tmp_filename, 0o644)
+        with open(fd, 'w', encoding='utf-8', buffering=1 << 20) as file:
+            if isinstance(content, str):
+                file.write(content)
+            else:
+                file.writelines(line + '\n' for line in content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
 
 
 def find_ip_address(text):
@@ -159,7 +174,7 @@ def int2ip(addr):
 
 
 def random_ip():
-    return int2ip(random.randint(1, 0xffffffff))
+    return '%d.%d.%d.%d' % struct.unpack('BBBB', os.urandom(4))
 
 
 def http_headers(keep_alive=False):
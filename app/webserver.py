@@ -2,6 +2,8 @@ from flask import Flask, Response, request, abort, render_template, jsonify, sen
 import logging
 import sys
 
+from itertools import starmap
+
 from proxytools.config import Config
 from proxytools.models import init_database, ProxyProtocol, ProxyStatus, Proxy, ProxyTest
 from proxytools.utils import configure_logging
@@ -34,8 +36,8 @@ def after_request(response):
 @app.route('/')
 def index():
     stats = {
-        'Proxy count': Proxy.select().count(),
-        'Test count': ProxyTest.select().count(),
+        'Proxy count': Proxy.row_count(),
+        'Test count': ProxyTest.row_count(),
     }
     return render_template('page.html', data=stats)
 
@@ -57,8 +59,8 @@ def proxydata():
     if max_age > 86400:
         max_age = 86400
 
-    if protocol:
-        protocol = ProxyProtocol[protocol.upper()]
+    # Empty parameter (e.g. "?protocol=") means no protocol filter
+    protocol = ProxyProtocol[protocol.upper()] if protocol else None
 
     if exclude_countries:
         exclude_countries = exclude_countries.split(',')
@@ -86,19 +88,19 @@ def proxylist():
     if max_age > 86400:
         max_age = 86400
 
-    if protocol:
-        protocol = ProxyProtocol[protocol.upper()]
+    # Empty parameter (e.g. "?protocol=") means no protocol filter
+    protocol = ProxyProtocol[protocol.upper()] if protocol else None
 
     if exclude_countries:
         exclude_countries = exclude_countries.split(',')
 
-    query = Proxy.get_valid(
+    query = Proxy.get_valid_url_parts(
         limit,
         max_age,
         protocol,
         exclude_countries)
 
-    data = [proxy.url() for proxy in query.execute()]
+    data = list(starmap(Proxy.url_format, query.iterator()))
 
     return jsonify(data)
 